@@ -1,52 +1,103 @@
 import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-import plotly.express as px
-import plotly.graph_objects as go
 import os
 import tempfile
 import streamlit as st
 from langchain_google_genai import GoogleGenerativeAI
-from langchain.chains import LLMChain
-from langchain.prompts import PromptTemplate
-import sys
+from langchain_core.globals import get_llm_cache, set_llm_cache
+from langchain_core.outputs import Generation
+from langchain_community.cache import SQLiteCache
 import traceback
 import io
+import re
+import threading
+from collections import OrderedDict
 
-class VisualizationAgent:
-    def __init__(self, api_key):
-        self.api_key = api_key
-        self.llm = self._get_llm()
-    
-    def _get_llm(self):
-        return GoogleGenerativeAI(model="gemini-2.0-flash", google_api_key=self.api_key)
-    
-    def _create_code_prompt(self, df, question):
-        """Create a prompt for code generation based on the dataframe and question."""
-        # column types to provide better context
-        numeric_cols = df.select_dtypes(include=['number']).columns.tolist()
-        categorical_cols = df.select_dtypes(include=['object', 'category']).columns.tolist()
-        datetime_cols = df.select_dtypes(include=['datetime', 'datetime64']).columns.tolist()
-        
-        # Format column information
-        col_info = "\nNumeric columns: " + ", ".join(numeric_cols) if numeric_cols else ""
-        col_info += "\nCategorical columns: " + ", ".join(categorical_cols) if categorical_cols else ""
-        col_info += "\nDatetime columns: " + ", ".join(datetime_cols) if datetime_cols else ""
-        
-        return f"""
+# First fenced code block; an unterminated fence runs to the end of the response
+_FENCE_RE = re.compile(r"```(?:python)?\s*\n?(.*?)(?:```|\Z)", re.DOTALL)
+
+# Question routing for _pick_llm
+_SIMPLE_PLOT_RE = re.compile(r"\b(histogram|bar|scatter|pie|line|plot|show|chart)s?\b", re.IGNORECASE)
+_ANALYTICAL_RE = re.compile(r"\b(correlat\w*|why|trends?|predict\w*)\b", re.IGNORECASE)
+
+# Persist LLM responses so repeated prompts skip the Gemini round-trip
+# (anchored next to this file, like history.json, so the working directory doesn't matter)
+set_llm_cache(SQLiteCache(database_path=os.path.join(os.path.dirname(__file__), ".viz_cache.db")))
+
+
+class _LRUCache:
+    """Small thread-safe LRU mapping shared across Streamlit sessions and reruns."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for key, or None."""
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Store value for key, evicting the least recently used entries."""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+# Long frames are fingerprinted from an evenly spaced row sample, so a cache
+# lookup stays much cheaper than the describe()/head() work it saves
+_FINGERPRINT_SAMPLE_ROWS = 10_000
+
+
+def _frame_fingerprint(df):
+    """Build a cheap hashable key identifying the dataframe schema and contents."""
+    sample = df
+    if len(df) > _FINGERPRINT_SAMPLE_ROWS:
+        sample = df.iloc[::len(df) // _FINGERPRINT_SAMPLE_ROWS]
+    return (
+        tuple(df.columns),
+        tuple(df.dtypes.astype(str)),
+        df.shape,
+        int(pd.util.hash_pandas_object(sample, index=True).sum()),
+    )
+
+
+# Raw LLM responses per (fingerprint, question), shared across reruns and streaming/blocking calls
+_response_cache = _LRUCache(maxsize=128)
+
+# Prompt context strings per _frame_fingerprint; describe() etc. are costly on big frames
+_profile_cache = _LRUCache(maxsize=8)
+
+# Limits that keep the prompt small on wide or long frames
+_PREVIEW_MAX_COLS = 15
+_DTYPES_MAX_ROWS = 40
+_COL_LIST_LIMIT = 20
+_STATS_SAMPLE_ROWS = 10_000
+
+
+# Code generation prompt; only the dataframe context and question vary per call
+_PROMPT_TEMPLATE = """
         You are a data analysis expert with advanced Python visualization skills.
         You've been given a pandas DataFrame 'df' with the following characteristics:
         
         DataFrame preview:
-        {df.head(5).to_string()}
+        {head}
         
         Column data types:
-        {df.dtypes.to_string()}
+        {dtypes}
         {col_info}
         
         Basic statistics:
-        {df.describe().to_string()}
+        {describe}
+        
+        Note: the listings above may be truncated for wide or long data ("..." marks omitted
+        columns or rows, and statistics are computed on a sample of up to {sample_rows:,} rows).
+        Only reference columns named above, or discover others from df.columns at runtime.
         
         User question: "{question}"
         
@@ -71,58 +122,218 @@ class VisualizationAgent:
             13. Do NOT include any sample or dummy data in your response. Work ONLY with the existing 'df' dataframe.
             14. Do NOT include import statements - these are already handled.
             """
+
+
+def _llm_cache_key(llm):
+    """The llm_string BaseLLM.generate uses for cache entries, so streamed responses
+    share the persistent cache with invoke() and batch()."""
+    return str(sorted(dict(llm.dict(), stop=None).items()))
+
+
+def _success_result(code):
+    """Result dict for successfully generated code."""
+    return {
+        "code": code,
+        "result": "Code generated successfully. Execute in Streamlit context.",
+        "status": "success"
+    }
+
+
+def _error_result(e, error_details):
+    """Result dict for a failed generation; the traceback is kept in the code for debugging."""
+    return {
+        "code": f"# Error generating code: {str(e)}\n\n'''\n{error_details}\n'''",
+        "result": f"Error: {str(e)}",
+        "status": "error"
+    }
+
+
+def _truncate_columns(cols):
+    """Cap a column name list, noting how many were left out."""
+    if len(cols) <= _COL_LIST_LIMIT:
+        return cols
+    return cols[:_COL_LIST_LIMIT] + [f"... (+{len(cols) - _COL_LIST_LIMIT} more)"]
+
+
+def _df_profile(df, fingerprint):
+    """Return the derived dataframe strings used in the prompt, computing them once per frame."""
+    profile = _profile_cache.get(fingerprint)
+    if profile is None:
+        # statistics on a sample are close enough for prompt context
+        stats_df = df
+        if len(df) > _STATS_SAMPLE_ROWS:
+            stats_df = df.sample(n=_STATS_SAMPLE_ROWS, random_state=0)
+
+        # column types to provide better context, in a single pass over the dtypes
+        numeric_cols, categorical_cols, datetime_cols = [], [], []
+        for name, dtype in df.dtypes.items():
+            kind = dtype.kind
+            if kind in "iufc":
+                numeric_cols.append(name)
+            elif kind in "OU" or isinstance(dtype, pd.CategoricalDtype):
+                categorical_cols.append(name)
+            elif kind == "M":
+                datetime_cols.append(name)
+        numeric_cols = _truncate_columns(numeric_cols)
+        categorical_cols = _truncate_columns(categorical_cols)
+        datetime_cols = _truncate_columns(datetime_cols)
+
+        # Format column information
+        col_info = "\nNumeric columns: " + ", ".join(numeric_cols) if numeric_cols else ""
+        col_info += "\nCategorical columns: " + ", ".join(categorical_cols) if categorical_cols else ""
+        col_info += "\nDatetime columns: " + ", ".join(datetime_cols) if datetime_cols else ""
+
+        profile = {
+            "head": df.head(3).to_string(max_cols=_PREVIEW_MAX_COLS),
+            "dtypes": df.dtypes.to_string(max_rows=_DTYPES_MAX_ROWS),
+            "describe": stats_df.describe().to_string(max_cols=_PREVIEW_MAX_COLS),
+            "col_info": col_info,
+        }
+        _profile_cache.put(fingerprint, profile)
+    return profile
+
+class VisualizationAgent:
+    def __init__(self, api_key):
+        self.api_key = api_key
+        # simple chart requests go to the lighter, lower-latency model
+        self.llm_fast = self._get_llm("gemini-2.0-flash-lite")
+        self.llm_smart = self._get_llm("gemini-2.0-flash")
+    
+    def _get_llm(self, model):
+        return GoogleGenerativeAI(model=model, google_api_key=self.api_key)
+    
+    def _pick_llm(self, question):
+        """Route plain plotting requests to the fast model and analytical questions to the smart one."""
+        if _SIMPLE_PLOT_RE.search(question) and not _ANALYTICAL_RE.search(question):
+            return self.llm_fast
+        return self.llm_smart
+    
+    def _create_code_prompt(self, df, question, fingerprint=None):
+        """Create a prompt for code generation based on the dataframe and question."""
+        if fingerprint is None:
+            fingerprint = _frame_fingerprint(df)
+        profile = _df_profile(df, fingerprint)
+        return _PROMPT_TEMPLATE.format(
+            head=profile["head"],
+            dtypes=profile["dtypes"],
+            col_info=profile["col_info"],
+            describe=profile["describe"],
+            sample_rows=_STATS_SAMPLE_ROWS,
+            question=question,
+        )
     
     def _generate_analysis_code(self, df, question):
         """Generate Python code for data analysis and visualization."""
-        prompt = self._create_code_prompt(df, question)
-        
-        #chain to generate the code
-        code_chain = LLMChain(
-            llm=self.llm,
-            prompt=PromptTemplate(
-                input_variables=["prompt"],
-                template="{prompt}"
-            )
-        )
+        # identical questions on identical data skip prompt construction entirely
+        fingerprint = _frame_fingerprint(df)
+        key = fingerprint + (question,)
+        response = _response_cache.get(key)
+        if response is None:
+            response = self._request_response(df, question, fingerprint)
+            _response_cache.put(key, response)
+        return self._extract_code(response)
+
+    def _request_response(self, df, question, fingerprint):
+        """Build the prompt and ask the LLM for analysis code."""
+        prompt = self._create_code_prompt(df, question, fingerprint)
         
         # Generate the code
-        response = code_chain.run(prompt=prompt)
-        return self._extract_code(response)
+        return self._pick_llm(question).invoke(prompt)
+
     def _extract_code(self, response):
         """Extract code blocks from the LLM response."""
-        # get just the code
-        if "```python" in response:
-            code_blocks = response.split("```python")
-            code = code_blocks[1].split("```")[0].strip()
-            return code
-        elif "```" in response:
-            code_blocks = response.split("```")
-            if len(code_blocks) > 1:
-                return code_blocks[1].strip()
+        # get just the code from the first fenced block
+        match = _FENCE_RE.search(response)
+        if match:
+            return match.group(1).strip()
         
         # If no code blocks found, return the raw response
         return response.strip()
     
-    def analyze_data(self, df, question):
-        """Main method to analyze data and return visualization code and execution."""
+    def analyze_data(self, df, question, on_chunk=None):
+        """Main method to analyze data and return visualization code and execution.
+
+        If on_chunk is given, the response is streamed and on_chunk is called with
+        the text received so far after every chunk.
+        """
         try:
             # analysis code
-            generated_code = self._generate_analysis_code(df, question)
+            if on_chunk is None:
+                generated_code = self._generate_analysis_code(df, question)
+            else:
+                response = ""
+                for chunk in self.analyze_data_stream(df, question):
+                    response += chunk
+                    on_chunk(response)
+                generated_code = self._extract_code(response)
             
-            
-            return {
-                "code": generated_code,
-                "result": "Code generated successfully. Execute in Streamlit context.",
-                "status": "success"
-            }
+            return _success_result(generated_code)
             
         except Exception as e:
             # treaceback for debugging
-            exc_info = sys.exc_info()
-            error_details = ''.join(traceback.format_exception(*exc_info))
-            
-            return {
-                "code": f"# Error generating code: {str(e)}\n\n'''\n{error_details}\n'''",
-                "result": f"Error: {str(e)}",
-                "status": "error"
-            }
+            return _error_result(e, traceback.format_exc())
+
+    def analyze_many(self, df, questions):
+        """Generate code for several questions, sending the uncached prompts to the LLM in parallel.
+
+        Returns one analyze_data-style result dict per question.
+        """
+        fingerprint = _frame_fingerprint(df)
+        keys = [fingerprint + (question,) for question in questions]
+        responses = [_response_cache.get(key) for key in keys]
+        
+        pending = [i for i, response in enumerate(responses) if response is None]
+        for llm in (self.llm_fast, self.llm_smart):
+            group = [i for i in pending if self._pick_llm(questions[i]) is llm]
+            if not group:
+                continue
+            prompts = [self._create_code_prompt(df, questions[i], fingerprint) for i in group]
+            batch = llm.batch(prompts, config={"max_concurrency": 8}, return_exceptions=True)
+            for i, response in zip(group, batch):
+                responses[i] = response
+                if not isinstance(response, Exception):
+                    _response_cache.put(keys[i], response)
+        
+        results = []
+        for response in responses:
+            if isinstance(response, Exception):
+                error_details = "".join(traceback.format_exception(type(response), response, response.__traceback__))
+                results.append(_error_result(response, error_details))
+            else:
+                results.append(_success_result(self._extract_code(response)))
+        return results
+
+    def analyze_data_stream(self, df, question):
+        """Yield the LLM response in chunks as it is generated.
+
+        Join the chunks and pass them through _extract_code to get the final code.
+        """
+        fingerprint = _frame_fingerprint(df)
+        key = fingerprint + (question,)
+        response = _response_cache.get(key)
+        if response is not None:
+            # the cached raw response, so the caller's _extract_code sees the same text
+            yield response
+            return
+
+        llm = self._pick_llm(question)
+        prompt = self._create_code_prompt(df, question, fingerprint)
+        
+        # stream() bypasses the LLM cache, so consult and update it here
+        llm_cache = get_llm_cache()
+        llm_string = _llm_cache_key(llm)
+        cached = llm_cache.lookup(prompt, llm_string) if llm_cache else None
+        if cached:
+            response = cached[0].text
+            _response_cache.put(key, response)
+            yield response
+            return
+
+        chunks = []
+        for chunk in llm.stream(prompt):
+            chunks.append(chunk)
+            yield chunk
+        response = "".join(chunks)
+        _response_cache.put(key, response)
+        if llm_cache:
+            llm_cache.update(prompt, llm_string, [Generation(text=response)])
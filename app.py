@@ -1,14 +1,17 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
+import matplotlib
+matplotlib.use("Agg")  # headless backend, skips GUI backend negotiation
 import matplotlib.pyplot as plt
-import seaborn as sns
-import plotly.express as px
-import plotly.graph_objects as go
 import os
 import tempfile
 import io
 import sys
+import json
+import hashlib
+import threading
+import uuid
 from dotenv import load_dotenv
 import google.generativeai as genai
 from agent import VisualizationAgent
@@ -38,6 +41,58 @@ Upload your structured data (CSV or Excel) and ask questions about it.
 The AI will analyze your data and create visualizations to answer your questions.
 """)
 
+# Visualization history is persisted here so returning users start warm. It maps
+# "<session id>:<data hash>" scopes to their entries, most recently saved last.
+HISTORY_PATH = os.path.join(os.path.dirname(__file__), "history.json")
+HISTORY_MAX_ENTRIES = 20
+HISTORY_MAX_SCOPES = 50
+
+# Per-browser-tab id kept in the URL, so a page refresh finds the same history
+if "sid" not in st.query_params:
+    st.query_params["sid"] = uuid.uuid4().hex
+SESSION_ID = st.query_params["sid"]
+
+# One lock for the whole server process; app.py itself re-executes on every rerun
+@st.cache_resource
+def history_lock():
+    return threading.Lock()
+
+def read_history_file():
+    try:
+        with open(HISTORY_PATH, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+def load_history(scope):
+    return read_history_file().get(scope, [])
+
+def save_history(scope, history):
+    # Bound the in-session history too, so the list shown matches what is persisted
+    del history[:-HISTORY_MAX_ENTRIES]
+    
+    with history_lock():
+        # Merge into the current file so other sessions' scopes are kept
+        data = read_history_file()
+        data.pop(scope, None)
+        data[scope] = history
+        while len(data) > HISTORY_MAX_SCOPES:
+            data.pop(next(iter(data)))
+        
+        # Write to a temp file and rename so a crash never leaves a truncated history
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(HISTORY_PATH), suffix=".json")
+        replaced = False
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, HISTORY_PATH)
+            replaced = True
+        finally:
+            # Never leave a stray temp file behind, whatever went wrong
+            if not replaced:
+                os.remove(tmp_path)
+
 # Initialize session state for storing data
 if 'df' not in st.session_state:
     st.session_state.df = None
@@ -45,30 +100,104 @@ if 'filename' not in st.session_state:
     st.session_state.filename = None
 if 'file_ext' not in st.session_state:
     st.session_state.file_ext = None
+if 'data_key' not in st.session_state:
+    st.session_state.data_key = None
 if 'visualization_history' not in st.session_state:
     st.session_state.visualization_history = []
+if 'history_scope' not in st.session_state:
+    st.session_state.history_scope = None
 if 'current_question' not in st.session_state:
     st.session_state.current_question = ""
 
+# Shrink inferred dtypes so later describe/plot/serialize work touches less memory,
+# but never at the cost of values the generated code and prompt statistics see.
+# Floats are only downcast when float32 holds every value exactly; otherwise
+# values like 250.01 turn into 250.009995 in describe() and sums drift.
+# Integers are left alone: narrow ints silently wrap in the arithmetic generated code runs.
+# Text stays as text: on categoricals, plain fillna/replace/assignment with a new
+# label and string concatenation raise TypeError in generated code.
+def optimize_dtypes(df):
+    for c in df.select_dtypes("float").columns:
+        downcast = pd.to_numeric(df[c], downcast="float")
+        if downcast.dtype != df[c].dtype and downcast.astype(df[c].dtype).equals(df[c]):
+            df[c] = downcast
+    return df
+
 # Function to load and parse data with caching
 @st.cache_data
-def load_data(uploaded_file):
-    filename = uploaded_file.name
+def load_data(file_bytes, filename):
+    # Takes raw bytes so Streamlit hashes the file contents, not the upload object
     file_ext = os.path.splitext(filename)[1].lower()
     
     try:
         if file_ext == '.csv':
-            df = pd.read_csv(uploaded_file)
+            df = pd.read_csv(io.BytesIO(file_bytes), engine="pyarrow")
         elif file_ext in ['.xlsx', '.xls']:
-            df = pd.read_excel(uploaded_file)
+            df = pd.read_excel(io.BytesIO(file_bytes), engine="calamine")
         else:
             st.error("Unsupported file format. Please upload a CSV or Excel file.")
-            return None, None, None
+            return None, None, None, None
         
-        return df, filename, file_ext
+        # Content hash that scopes the persisted history to this data
+        data_key = hashlib.sha256(file_bytes).hexdigest()[:16]
+        return optimize_dtypes(df), filename, file_ext, data_key
     except Exception as e:
         st.error(f"Error loading file: {e}")
-        return None, None, None
+        return None, None, None, None
+
+# Plotting libraries are imported on first use to keep app cold start fast
+def _plot_globals():
+    import seaborn as sns
+    import plotly.express as px
+    import plotly.graph_objects as go
+    return {"sns": sns, "px": px, "go": go}
+
+# Compiled generated code, so the same source is only parsed once
+@st.cache_resource(max_entries=32, show_spinner=False)
+def compile_code(code):
+    return compile(code, "<generated_viz>", "exec")
+
+# Execute generated code once per (code, data); Streamlit replays the rendered
+# elements on later reruns instead of executing the history again.
+# The frame is keyed by load_data's content hash rather than hashed on every call.
+@st.cache_resource(max_entries=32, show_spinner=False)
+def run_visualization_code(code, _df, data_key):
+    existing_figs = set(plt.get_fignums())
+    # Fresh namespace per entry so generated code can't leak state into the app or other entries
+    exec(compile_code(code), {"df": _df, "st": st, "pd": pd, "np": np, "plt": plt, **_plot_globals()})
+    
+    # Keep the matplotlib figures for saving, but detach them from pyplot's
+    # global state so they don't leak into the next entry
+    figures = [plt.figure(num) for num in plt.get_fignums() if num not in existing_figs]
+    for fig in figures:
+        plt.close(fig)
+    return {"figures": figures}
+
+# df.info() and describe() walk every cell, so only compute them once per dataframe;
+# keyed by load_data's content hash so reruns don't hash the frame either
+@st.cache_data(show_spinner=False)
+def df_info_str(_df, data_key):
+    buffer = io.StringIO()
+    _df.info(buf=buffer)
+    return buffer.getvalue()
+
+@st.cache_data(show_spinner=False)
+def df_stats(_df, data_key):
+    return _df.describe()
+
+# Preview, info and statistics panels for the loaded dataframe
+def render_df_overview(df, data_key):
+    col1, col2 = st.columns(2)
+    with col1:
+        st.subheader("Data Preview")
+        st.dataframe(df.head())
+    
+    with col2:
+        st.subheader("Data Information")
+        st.text(df_info_str(df, data_key))
+        
+        st.subheader("Data Statistics")
+        st.dataframe(df_stats(df, data_key))
 
 # Initialize Visualization Agent
 agent = VisualizationAgent(api_key=GOOGLE_API_KEY)
@@ -82,70 +211,37 @@ data_source = st.radio(
     ("Upload your own data", "Use sample data")
 )
 
+df, filename, file_ext, data_key = None, None, None, None
 if data_source == "Upload your own data":
     uploaded_file = st.file_uploader("Upload your CSV or Excel file", type=['csv', 'xlsx', 'xls'])
     
     if uploaded_file is not None:
-        # Load and display the data
-        df, filename, file_ext = load_data(uploaded_file)
-        
-        # Store in session state if data loaded successfully
-        if df is not None:
-            st.session_state.df = df
-            st.session_state.filename = filename
-            st.session_state.file_ext = file_ext
-            
-            st.success(f"File '{filename}' loaded successfully!")
-            
-            # Display dataframe info
-            col1, col2 = st.columns(2)
-            with col1:
-                st.subheader("Data Preview")
-                st.dataframe(df.head())
-            
-            with col2:
-                st.subheader("Data Information")
-                buffer = io.StringIO()
-                df.info(buf=buffer)
-                info_str = buffer.getvalue()
-                st.text(info_str)
-                
-                st.subheader("Data Statistics")
-                st.dataframe(df.describe())
+        # Load the data
+        df, filename, file_ext, data_key = load_data(uploaded_file.getvalue(), uploaded_file.name)
 else:
-    # Load sample data
+    # Load sample data through the same cached parser
     try:
         sample_path = os.path.join(os.path.dirname(__file__), "sample_data.csv")
-        df = pd.read_csv(sample_path)
-        filename = "sample_data.csv"
-        file_ext = ".csv"
-        st.success("Sample data loaded successfully!")
+        with open(sample_path, "rb") as f:
+            df, filename, file_ext, data_key = load_data(f.read(), "sample_data.csv")
     except Exception as e:
         st.error(f"Error loading sample data: {e}")
-        df, filename, file_ext = None, None, None
+
+# Store in session state and display if data loaded successfully
+if df is not None:
+    st.session_state.df = df
+    st.session_state.filename = filename
+    st.session_state.file_ext = file_ext
+    st.session_state.data_key = data_key
     
-    if df is not None:
-        st.session_state.df = df
-        st.session_state.filename = filename
-        st.session_state.file_ext = file_ext
-        
-        st.success(f"File '{filename}' loaded successfully!")
-        
-        # Display dataframe info
-        col1, col2 = st.columns(2)
-        with col1:
-            st.subheader("Data Preview")
-            st.dataframe(df.head())
-        
-        with col2:
-            st.subheader("Data Information")
-            buffer = io.StringIO()
-            df.info(buf=buffer)
-            info_str = buffer.getvalue()
-            st.text(info_str)
-            
-            st.subheader("Data Statistics")
-            st.dataframe(df.describe())
+    # Switch to the persisted history for this session and data
+    history_scope = f"{SESSION_ID}:{data_key}"
+    if st.session_state.history_scope != history_scope:
+        st.session_state.history_scope = history_scope
+        st.session_state.visualization_history = load_history(history_scope)
+    
+    st.success(f"File '{filename}' loaded successfully!")
+    render_df_overview(df, data_key)
 
 # User question input
 if st.session_state.df is not None:
@@ -168,6 +264,32 @@ if st.session_state.df is not None:
         if cols[i % 3].button(question, key=f"example_{i}"):
             st.session_state.current_question = question
     
+    # Generate all example questions at once so later clicks are instant
+    if st.button("Pre-compute all examples"):
+        with st.spinner("Generating all example visualizations... This may take a moment."):
+            try:
+                # Only generate examples that aren't already in the history
+                answered = {
+                    entry["question"] for entry in st.session_state.visualization_history
+                    if entry["status"] == "success"
+                }
+                missing = [example for example in example_questions if example not in answered]
+                if missing:
+                    results = agent.analyze_many(st.session_state.df, missing)
+                    for example, result in zip(missing, results):
+                        st.session_state.visualization_history.append({"question": example, **result})
+                    save_history(st.session_state.history_scope, st.session_state.visualization_history)
+                    
+                    failed = sum(result["status"] != "success" for result in results)
+                    if failed:
+                        st.error(f"{failed} of {len(missing)} example visualizations failed to generate.")
+                    else:
+                        st.success("Example visualizations generated successfully!")
+                else:
+                    st.success("All example visualizations are already in the history.")
+            except Exception as e:
+                st.error(f"Error generating visualizations: {e}")
+    
     question = st.text_input(
         "What would you like to know about your data?", 
         value=st.session_state.get("current_question", ""),
@@ -176,19 +298,24 @@ if st.session_state.df is not None:
     if st.button("Generate Visualization") and question:
         with st.spinner("Generating visualization... This may take a moment."):
             try:
-                # Generate and execute code using the agent
-                result = agent.analyze_data(st.session_state.df, question)
-                
+                # Stream the generated code so the user sees it as it arrives
+                placeholder = st.empty()
+                result = agent.analyze_data(
+                    st.session_state.df,
+                    question,
+                    on_chunk=lambda text: placeholder.code(text, language="python")
+                )
+                placeholder.empty()
+
                 # Add to history
-                st.session_state.visualization_history.append({
-                    "question": question,
-                    "code": result.get("code", ""),
-                    "result": result.get("result", ""),
-                    "status": result.get("status", "unknown")
-                })
+                st.session_state.visualization_history.append({"question": question, **result})
+                save_history(st.session_state.history_scope, st.session_state.visualization_history)
                 
-                # Display success message                
-                st.success("Visualization generated successfully!")
+                # Display result message
+                if result["status"] == "success":
+                    st.success("Visualization generated successfully!")
+                else:
+                    st.error(f"Error generating visualization: {result['result']}")
                 
             except Exception as e:
                 st.error(f"Error generating visualization: {e}")
@@ -203,9 +330,9 @@ if st.session_state.df is not None:
                 st.markdown(f"**Status:** {entry['status']}")
                 tabs = st.tabs(["Result", "Generated Code"])
                 with tabs[0]:
-                    # Execute the code directly
+                    # Execute the code (cached across reruns)
                     try:
-                        exec(entry['code'])
+                        rendered = run_visualization_code(entry['code'], st.session_state.df, st.session_state.data_key)
                         
                         # download button for the current visualization
                         if "plt" in entry['code'] or "px" in entry['code'] or "go" in entry['code']:
@@ -213,11 +340,11 @@ if st.session_state.df is not None:
                             save_options = st.columns(3)
                             
                             # for matplotlib
-                            if "plt" in entry['code']:
+                            if rendered["figures"]:
                                 with save_options[0]:
                                     if st.button("Save as PNG", key=f"png_{i}"):
                                         # Add code to save matplotlib figure
-                                        plt.savefig(f"visualization_{i}.png", dpi=300, bbox_inches='tight')
+                                        rendered["figures"][-1].savefig(f"visualization_{i}.png", dpi=300, bbox_inches='tight')
                                         st.success(f"Saved as visualization_{i}.png")
                             
                             